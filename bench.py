@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""usage: bench.py path [-s=]... [-e=] [-h]
+
+Arguments:
+
+path                An audio file to render.
+
+Options:
+
+-s, --segment       A segment to cut (hh:mm:ss-hh:mm:ss). May be
+                    given more than once. Defaults to the whole file.
+-e, --engines       Comma separated engines to compare.
+                    Defaults to every engine.
+-h, --help          Show this help message and exit.
+
+Requirements:
+
+sox, numpy, scipy
+
+#---------------------------------------------------------------------#
+
+This script will render the given audio with each engine, report how
+long each took and its realtime factor, then compare the output of
+every engine against the sox output so the fastest engine that is
+accurate enough can be picked for this host.
+
+"""
+
+import os
+import sys
+import getopt
+import timeit
+
+import numpy as np
+
+from ui import *
+from metadata import *
+from engine import *
+from process import cut, audio_seconds
+
+
+def bench(path, segments=None, engines=ENGINES):
+    metadata = MetadataList.Metadata({
+        'filepath': path,
+        'segments': segments if segments else [],
+    })
+    seconds = audio_seconds(metadata)
+
+    print_title('Rendering {0} ({1:.0f}s of audio)'.format(path, seconds))
+
+    outputs = {}
+    try:
+        for name in engines:
+            outputs[name] = TempFile('.mp3')
+            start = timeit.default_timer()
+            cut(path, outputs[name].path, metadata, get_engine(name))
+            time = timeit.default_timer() - start
+            print('{0}{1:<8}{2}{3:>8.1f}s {4:>7.1f}x realtime'.format(
+                Style.BOLD,
+                name,
+                Style.END,
+                time,
+                seconds / time if time else 0,
+            ))
+
+        if 'sox' in outputs:
+            print_title('\nAccuracy against sox')
+            for name in outputs:
+                if name != 'sox':
+                    compare(outputs['sox'].path, outputs[name].path, name)
+
+    finally:
+        for output in outputs.values():
+            output.close()
+
+
+def compare(reference_path, path, name):
+    # Print how far the output of an engine is from the reference
+    with TempFile('.f32') as reference_pcm, TempFile('.f32') as pcm:
+        reference, _ = decode(reference_path, reference_pcm.path)
+        samples, _ = decode(path, pcm.path)
+
+        frames = min(len(reference), len(samples))
+        reference = reference[:frames, 0].astype(np.float64)
+        samples = samples[:frames, 0].astype(np.float64)
+
+        error = samples - reference
+        print(
+            '{0}{1:<8}{2}error {3:>6.1f}dB  peak error {4:>6.1f}dB  '
+            'correlation {5:.4f}  length {6:+d} frames'.format(
+                Style.BOLD,
+                name,
+                Style.END,
+                decibels(rms(error) / rms(reference)),
+                decibels(np.max(np.abs(error), initial=0)),
+                np.corrcoef(reference, samples)[0, 1] if frames > 1 else 0,
+                len(samples) - len(reference),
+            )
+        )
+
+
+def rms(samples):
+    return np.sqrt(np.mean(np.square(samples))) if len(samples) else 0
+
+
+def decibels(ratio):
+    return 20 * np.log10(max(ratio, 1e-10))
+
+
+def _args():
+    path = None
+    segments = []
+    engines = ENGINES
+
+    try:
+        opts, args = getopt.gnu_getopt(
+            sys.argv[1:],
+            's:e:h',
+            ['segment=', 'engines=', 'help']
+        )
+    except getopt.GetoptError as err:
+        print(str(err))
+        sys.exit(1)
+
+    for option, value in opts:
+        if option in ('-h', '--help'):
+            print(__doc__)
+            sys.exit(0)
+        elif option in ('-s', '--segment'):
+            if not is_valid_segment(value):
+                print_error('{} is not a valid segment'.format(value))
+                sys.exit(1)
+            segments.append(value)
+        elif option in ('-e', '--engines'):
+            engines = value.split(',')
+
+    for engine in engines:
+        if engine not in ENGINES:
+            print_error('{0} is not a valid engine ({1})'.format(
+                engine,
+                ', '.join(ENGINES),
+            ))
+            sys.exit(1)
+
+    if args:
+        path = args[0]
+    else:
+        print_error('You must provide an input path')
+        sys.exit(1)
+
+    if not path or not os.path.isfile(path):
+        print_error('{} is not a valid input file'.format(path))
+        sys.exit(1)
+
+    return (path, segments, engines)
+
+
+if __name__ == '__main__':
+    bench(*_args())
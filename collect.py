@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-"""usage: collect.py path [-o=] [-h]
+"""usage: collect.py path [-o=] [-t=] [-s=] [-i] [-b] [-h]
 
 Arguments:
 
@@ -10,6 +10,14 @@ path                The directory path containing raw
 Options:
 
 -o, --output-csv    The csv filepath to write results to.
+-t, --template      A regex matched against each filename. Named
+                    groups title, speakers, segments and event_name
+                    fill in those fields, e.g.
+                    '(?P<speakers>.+) - (?P<title>.+)'
+-s, --schedule      A json or csv file of metadata for each file,
+                    with the same fields as the output csv.
+-i, --id3           Fill in fields from existing ID3 tags.
+-b, --batch         Only import metadata, never prompt.
 -h, --help          Show this help message and exit.
 
 Requirements:
@@ -26,22 +34,43 @@ If the output csv is not specified. A csv file will be
 created in current working directory with the same name
 as the input directory.
 
+Metadata can be imported in bulk from filenames, a schedule
+and ID3 tags. Only files with missing fields are then
+prompted for.
+
 """
 
 import os
+import re
 import sys
 import getopt
 
 from ui import *
 from metadata import *
 
+# Probed durations of VBR MP3s without a Xing header are estimates, and
+# sox trims past the end harmlessly, so a segment may end this many
+# seconds after the probed duration
+DURATION_TOLERANCE = 1
+
 
-def collect_metadata(path, output_csv=None):
+def collect_metadata(
+    path,
+    output_csv=None,
+    template=None,
+    schedule=None,
+    id3=False,
+    batch=False,
+):
     """Collect raw audio metadata from terminal ui and write results to csv
 
     Args:
         path: The directory path containing raw audio to be processed.
         output_csv: Optional csv filepath to write results to
+        template: Optional filename regex to import metadata with
+        schedule: Optional json or csv schedule to import metadata from
+        id3: Import metadata from existing ID3 tags
+        batch: Only import metadata, never prompt
 
     Returns:
         MetadataList object containing results
@@ -62,6 +91,23 @@ def collect_metadata(path, output_csv=None):
     if os.path.isfile(output_csv):
         metadata_list.read_from_csv(output_csv)
 
+    # Recover any edits from a session that crashed before saving
+    journal = MetadataJournal(metadata_list, output_csv)
+    journal.replay()
+
+    importing = template or schedule or id3
+
+    if batch:
+        metadata_list.import_metadata(
+            audio_files, event_name, template, schedule, id3
+        )
+        print_info('{0} of {1} audio files have complete metadata'.format(
+            sum(1 for item in metadata_list if item.is_complete()),
+            len(audio_files),
+        ))
+        metadata_list.write_to_csv(output_csv)
+        return metadata_list
+
     clear_and_title(
         'Welcome to CAPS, a SALTY Conference Audio Processing System'
     )
@@ -79,52 +125,85 @@ def collect_metadata(path, output_csv=None):
             default=event_name,
         )
 
+        if importing:
+            metadata_list.import_metadata(
+                audio_files, event_name, template, schedule, id3
+            )
+            audio_files = [
+                file for file in audio_files
+                if not metadata_list.get_item('filepath', file).is_complete()
+            ]
+            print_info('{} audio files need metadata'.format(
+                len(audio_files)
+            ))
+
         if not confirm('\nAre you ready to play audio? Raw audio could be very loud.', default='yes'):
             sys.exit(0)
 
-        for file in audio_files:
-            clear_and_title('\nOpening ' + file)
-
-            metadata = metadata_list.get_item('filepath', file)
-
-            if metadata:
-                metadata.print_pretty()
-
-            with VLCPlayer(file) as vlc:
-                if confirm('\nSkip this file?', default='yes'):
-                    continue
-
-                if not metadata:
-                    metadata = metadata_list.add_item({
-                        'filepath': file,
-                        'event_name': event_name,
-                        'title': None,
-                        'speakers': None,
-                        'segments': None,
-                    })
-
-                metadata['title'] = prompt(
-                    input_prompt='Title',
-                    message='\nEnter the title for this audio',
-                    condition=lambda x: True if x else False,
-                    error='You must enter a title',
-                    default=metadata['title'],
-                )
-
-                metadata['speakers'] = multi_prompt(
-                    input_prompt='Speaker',
-                    message='\nInput each speakers name',
-                    defaults=metadata['speakers'],
-                )
-
-                metadata['segments'] = multi_prompt(
-                    input_prompt='Segment',
-                    message='\nInput start and end cut of each audio segment (hh:mm:ss-hh:mm:ss)',
-                    condition=is_valid_segment,
-                    error='You must input the correct format (hh:mm:ss-hh:mm:ss)'
-                    ' and start cut must precede end cut',
-                    defaults=metadata['segments'],
-                )
+        with Prefetcher(audio_files) as prefetcher:
+            for index, file in enumerate(audio_files):
+                # Start warming up the files after this one while the
+                # operator works on it
+                prefetcher.advance(index)
+
+                clear_and_title('\nOpening ' + file)
+
+                probe = prefetcher.get(file)
+                duration = probe['duration']
+
+                if duration:
+                    print_info('Duration: {}'.format(
+                        seconds_timestamp(duration)
+                    ))
+
+                metadata = metadata_list.get_item('filepath', file)
+
+                if metadata:
+                    metadata.print_pretty()
+
+                with VLCPlayer(file) as vlc:
+                    if confirm('\nSkip this file?', default='yes'):
+                        continue
+
+                    if not metadata:
+                        # Suggest whatever the file is already tagged with
+                        metadata = metadata_list.add_item({
+                            'filepath': file,
+                            'event_name': event_name,
+                            'title': probe['tags'].get('title'),
+                            'speakers': probe['tags'].get('speakers'),
+                            'segments': None,
+                        })
+
+                    metadata['title'] = prompt(
+                        input_prompt='Title',
+                        message='\nEnter the title for this audio',
+                        condition=lambda x: True if x else False,
+                        error='You must enter a title',
+                        default=metadata['title'],
+                    )
+
+                    metadata['speakers'] = multi_prompt(
+                        input_prompt='Speaker',
+                        message='\nInput each speakers name',
+                        defaults=metadata['speakers'],
+                    )
+
+                    metadata['segments'] = multi_prompt(
+                        input_prompt='Segment',
+                        message='\nInput start and end cut of each audio segment (hh:mm:ss-hh:mm:ss)',
+                        condition=lambda x: is_valid_segment(x) and not (
+                            x and duration
+                            and segment_seconds(x)[1]
+                            > duration + DURATION_TOLERANCE
+                        ),
+                        error='You must input the correct format (hh:mm:ss-hh:mm:ss)'
+                        ', start cut must precede end cut'
+                        ' and end cut must be within the audio',
+                        defaults=metadata['segments'],
+                    )
+
+                    journal.append(metadata)
 
     except (KeyboardInterrupt, EOFError):
         print_error('\nAborted')
@@ -132,18 +211,22 @@ def collect_metadata(path, output_csv=None):
         return metadata_list
     finally:
         if metadata_list and output_csv:
-            metadata_list.write_to_csv(output_csv)
+            journal.compact()
 
 
 def _args():
     path = None
     output_csv = None
+    template = None
+    schedule = None
+    id3 = False
+    batch = False
 
     try:
         opts, args = getopt.gnu_getopt(
             sys.argv[1:],
-            'o:h',
-            ['output-csv=', 'help']
+            'o:t:s:ibh',
+            ['output-csv=', 'template=', 'schedule=', 'id3', 'batch', 'help']
         )
     except getopt.GetoptError as err:
         print(str(err))
@@ -155,11 +238,33 @@ def _args():
             sys.exit(0)
         elif option in ('-o', '--output-csv'):
             output_csv = value
+        elif option in ('-t', '--template'):
+            template = value
+        elif option in ('-s', '--schedule'):
+            schedule = value
+        elif option in ('-i', '--id3'):
+            id3 = True
+        elif option in ('-b', '--batch'):
+            batch = True
 
     if output_csv and not os.path.isfile(output_csv):
         print_error('{} is not a valid output file'.format(output_csv))
         sys.exit(1)
 
+    if template:
+        try:
+            re.compile(template)
+        except re.error as err:
+            print_error('{0} is not a valid template: {1}'.format(
+                template,
+                err,
+            ))
+            sys.exit(1)
+
+    if schedule and not os.path.isfile(schedule):
+        print_error('{} is not a valid schedule file'.format(schedule))
+        sys.exit(1)
+
     if args:
         path = args[0]
     else:
@@ -170,7 +275,7 @@ def _args():
         print_error('{} is not a valid input path'.format(path))
         sys.exit(1)
 
-    return (path, output_csv)
+    return (path, output_csv, template, schedule, id3, batch)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+"""
+dsp.py
+
+This module is an in-process implementation of the CAPS filter chain
+built on NumPy and SciPy. Audio is decoded once by sox into raw 32 bit
+float PCM, memory-mapped, and then processed block by block with
+vectorised filters so even very long recordings never need to fit in
+memory. Only decoding the input and encoding the final MP3 fork sox,
+using the decode() and encode() helpers of engine.py.
+
+The biquad filters are the same RBJ cookbook designs sox uses. The
+compander follows the sox attack/decay envelope once per millisecond
+and interpolates its transfer curve linearly in dB without a soft
+knee, so expect small differences around the knees. Use bench.py to
+measure speed and accuracy against the sox engine on a given host.
+
+#---------------------------------------------------------------------#
+
+Classes and functions defined in this module include:
+
+    NumpyEngine
+    FilterChain
+    Compander
+    biquad
+"""
+
+import numpy as np
+
+from scipy.signal import sosfilt
+
+from engine import *
+
+# Number of frames processed at a time from a memory-mapped file
+BLOCK_FRAMES = 1 << 20
+
+# The compander envelope is followed once per this many seconds
+COMPAND_RESOLUTION = 0.001
+
+
+class NumpyEngine:
+    # Render the filter chain in-process over memory-mapped PCM blocks.
+    name = 'numpy'
+
+    def __init__(self, block_frames=BLOCK_FRAMES):
+        self.block_frames = block_frames
+
+    def render(self, input_path, output_file, segments, stats=None):
+        # Cut and filter in a single pass over the decoded input. The
+        # chain keeps its state across segments, just like sox filtering
+        # the concatenated segments as one stream.
+        with TempFile('.f32') as decoded, TempFile('.f32') as processed:
+            samples, rate = decode(input_path, decoded.path)
+            blocks, frames = self.cut(samples, rate, segments)
+            write(processed.path, frames, FilterChain(rate).stream(blocks))
+            encode(processed.path, rate, CHANNELS, output_file)
+
+    def segment(self, input_path, output_file, segments):
+        with TempFile('.f32') as decoded, TempFile('.f32') as processed:
+            samples, rate = decode(input_path, decoded.path)
+            blocks, frames = self.cut(samples, rate, segments)
+            write(processed.path, frames, blocks)
+            encode(processed.path, rate, CHANNELS, output_file)
+
+    def filter(self, input_path, output_file, start=None, end=None):
+        with TempFile('.f32') as decoded, TempFile('.f32') as processed:
+            samples, rate = decode(input_path, decoded.path, start, end)
+            blocks = (
+                downmix(samples[offset:offset + self.block_frames])
+                for offset in range(0, len(samples), self.block_frames)
+            )
+            chain = FilterChain(rate)
+            write(processed.path, len(samples), chain.stream(blocks))
+            encode(processed.path, rate, CHANNELS, output_file)
+
+    def cut(self, samples, rate, segments):
+        # Returns a generator of downmixed, normalised and faded blocks
+        # of every segment in turn, and the total number of frames.
+        gain = self.norm_gain(samples)
+
+        if not segments:
+            # Nothing to cut so process the whole input unfaded
+            spans = [(0, len(samples))]
+            fade = False
+        else:
+            spans = [
+                (round(start * rate), min(round(end * rate), len(samples)))
+                for start, end in segments
+            ]
+            fade = True
+
+        def blocks():
+            for start, end in spans:
+                length = max(end - start, 0)
+                for offset in range(0, length, self.block_frames):
+                    stop = min(offset + self.block_frames, length)
+                    block = downmix(samples[start + offset:start + stop])
+                    block *= gain
+                    if fade:
+                        block *= fade_envelope(offset, stop, length, rate)
+                    yield block
+
+        return blocks(), sum(max(end - start, 0) for start, end in spans)
+
+    def norm_gain(self, samples):
+        # Gain that normalises the peak of the downmixed input to NORM_DB.
+        # Like sox norm, the peak is taken over the whole input.
+        peak = 0
+        for offset in range(0, len(samples), self.block_frames):
+            block = downmix(samples[offset:offset + self.block_frames])
+            peak = max(peak, float(np.max(np.abs(block), initial=0)))
+
+        if not peak:
+            return 1
+        return 10 ** (NORM_DB / 20) / peak
+
+
+class FilterChain:
+    # Stateful highpass, lowpass, compand and EQ chain. Successive
+    # calls to process() followed by flush() behave as if the blocks
+    # were one stream.
+    def __init__(self, rate):
+        self.filters = np.vstack([
+            biquad('highpass', HIGHPASS, rate),
+            biquad('lowpass', LOWPASS, rate),
+        ])
+        self.equalizers = np.vstack([
+            biquad('equalizer', frequency, rate, width_q, gain_db)
+            for frequency, width_q, gain_db in EQUALIZERS
+        ])
+        self.compander = Compander(rate)
+        self.filters_zi = np.zeros((len(self.filters), 2))
+        self.equalizers_zi = np.zeros((len(self.equalizers), 2))
+
+    def process(self, block):
+        # The compander holds back a partial control block, so fewer
+        # frames than were passed in may come out
+        block, self.filters_zi = sosfilt(
+            self.filters, block, zi=self.filters_zi
+        )
+        return self.equalize(self.compander.process(block))
+
+    def flush(self):
+        # Return the frames still held back by the compander
+        return self.equalize(self.compander.flush())
+
+    def stream(self, blocks):
+        # Filter every block of a stream in turn, then flush
+        for block in blocks:
+            yield self.process(block)
+        yield self.flush()
+
+    def equalize(self, block):
+        if not len(block):
+            return block.astype(np.float32)
+        block, self.equalizers_zi = sosfilt(
+            self.equalizers, block, zi=self.equalizers_zi
+        )
+        return block.astype(np.float32)
+
+
+class Compander:
+    # Dynamic range compression with the sox compand transfer curve.
+    # The envelope follows the peak level of short control blocks with
+    # separate attack and decay rates and the resulting gain is
+    # interpolated back to the sample rate.
+    def __init__(self, rate):
+        # Control blocks divide a second exactly so chunks that start
+        # on whole seconds see the same grid as a serial render
+        self.step = next(
+            step for step in range(max(1, round(rate * COMPAND_RESOLUTION)),
+                                   rate + 1)
+            if rate % step == 0
+        )
+        self.attack = self.coefficient(rate, COMPAND_ATTACK)
+        self.decay = self.coefficient(rate, COMPAND_DECAY)
+        self.levels = np.array([point[0] for point in COMPAND_POINTS])
+        self.gains = np.array([out - level for level, out in COMPAND_POINTS])
+        self.volume = 0.0
+        self.gain = None
+        self.pending = np.zeros(0)
+
+    def coefficient(self, rate, time):
+        # Per control block smoothing coefficient for a time constant
+        if time * rate <= self.step:
+            return 1.0
+        return 1 - np.exp(-self.step / (rate * time))
+
+    def process(self, block):
+        # Keep any partial control block for the next call so the
+        # envelope is evaluated on the same grid however audio arrives
+        block = np.concatenate([self.pending, block])
+        whole = len(block) - len(block) % self.step
+        block, self.pending = block[:whole], block[whole:]
+
+        if not whole:
+            return block
+
+        peaks = np.abs(block).reshape(-1, self.step).max(axis=1)
+
+        # The envelope is a non-linear recurrence so it cannot be
+        # vectorised, but it only runs once per control block
+        envelope = np.empty(len(peaks))
+        volume = self.volume
+        for index, peak in enumerate(peaks.tolist()):
+            delta = peak - volume
+            volume += delta * (self.attack if delta > 0 else self.decay)
+            envelope[index] = volume
+        self.volume = volume
+
+        level_db = 20 * np.log10(np.maximum(envelope, 1e-10))
+        gain = 10 ** (np.interp(level_db, self.levels, self.gains) / 20)
+
+        # Interpolate gain between control block centres, starting
+        # from where the previous call left off
+        previous = self.gain if self.gain is not None else gain[0]
+        self.gain = gain[-1]
+        centres = np.arange(-1, len(gain)) * self.step + self.step / 2
+        gain = np.interp(
+            np.arange(whole),
+            centres,
+            np.concatenate([[previous], gain]),
+        )
+        return block * gain
+
+    def flush(self):
+        # Return the trailing partial control block, if any
+        block, self.pending = self.pending, np.zeros(0)
+        if self.gain is None:
+            return block
+        return block * self.gain
+
+
+def biquad(kind, frequency, rate, width_q=0.707, gain_db=0):
+    # Second order section for an RBJ cookbook filter, the same
+    # designs sox uses for highpass, lowpass and equalizer.
+    if not 0 < frequency < rate / 2:
+        raise ValueError(
+            '{0} frequency {1} must be below half the sample rate {2}'.format(
+                kind, frequency, rate,
+            )
+        )
+
+    w0 = 2 * np.pi * frequency / rate
+    cos = np.cos(w0)
+    alpha = np.sin(w0) / (2 * width_q)
+
+    if kind == 'highpass':
+        b = [(1 + cos) / 2, -(1 + cos), (1 + cos) / 2]
+        a = [1 + alpha, -2 * cos, 1 - alpha]
+    elif kind == 'lowpass':
+        b = [(1 - cos) / 2, 1 - cos, (1 - cos) / 2]
+        a = [1 + alpha, -2 * cos, 1 - alpha]
+    elif kind == 'equalizer':
+        amplitude = 10 ** (gain_db / 40)
+        b = [1 + alpha * amplitude, -2 * cos, 1 - alpha * amplitude]
+        a = [1 + alpha / amplitude, -2 * cos, 1 - alpha / amplitude]
+    else:
+        raise ValueError('Unknown biquad: {}'.format(kind))
+
+    return np.concatenate([b, a]) / a[0]
+
+
+def downmix(block):
+    # Average every channel of a (frames, channels) block into one
+    return block.mean(axis=1, dtype=np.float64)
+
+
+def fade_envelope(start, stop, length, rate):
+    # Linear fade in and fade out gain for frames start:stop of a
+    # segment that is length frames long
+    frames = np.arange(start, stop, dtype=np.float64)
+    fade_in = np.minimum(frames / (FADE_IN * rate), 1)
+    fade_out = np.minimum((length - frames) / (FADE_OUT * rate), 1)
+    return fade_in * fade_out
+
+
+if __name__ == "__main__":
+    print(__doc__)
@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+
+"""
+engine.py
+
+This module is a library of audio engines. An engine renders the CAPS
+filter chain: cut audio into segments, downmix, normalise and fade
+each segment, then filter, compress and EQ the joined result.
+
+Every engine has the same interface, render(input_path, output_file,
+segments), so process.py can swap between them per host. Engines also
+expose the two stages of render() on their own, segment() and
+filter(), so ChunkedEngine can wrap either engine to split very long
+recordings into overlapping chunks that are filtered in parallel and
+stitched back together with sample-accurate crossfades.
+
+#---------------------------------------------------------------------#
+
+Classes and functions defined in this module include:
+
+    SoxEngine
+    ChunkedEngine
+    sox_args
+    combine_args
+    run_commands
+    get_engine
+    decode
+    write
+    encode
+    TempFile
+"""
+
+import os
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from tempfile import mkstemp
+from sox import Transformer, Combiner, file_info
+
+# The names of the engines get_engine() knows how to build
+ENGINES = ('sox', 'numpy')
+
+# Parameters of the CAPS filter chain, shared by every engine
+CHANNELS = 1
+NORM_DB = -24
+FADE_IN = 1
+FADE_OUT = 2
+HIGHPASS = 100
+LOWPASS = 10000
+COMPAND_ATTACK = 0.005
+COMPAND_DECAY = 0.12
+COMPAND_KNEE_DB = 6
+COMPAND_POINTS = [
+    (-90, -90),
+    (-70, -55),
+    (-50, -35),
+    (-32, -32),
+    (-24, -24),
+    (0, -8),
+]
+# Peaking equalizers as (frequency, width_q, gain_db)
+EQUALIZERS = [
+    (3000, 1000, 3),
+    (280, 120, 3),
+]
+
+# Length of the chunks long recordings are split into, how far each
+# chunk is rendered ahead of its start and how much of that lead is
+# crossfaded with the previous chunk, all in seconds
+CHUNK_SECONDS = 30 * 60
+CHUNK_OVERLAP = 5
+CHUNK_CROSSFADE = 0.05
+
+
+class SoxEngine:
+    # Render the filter chain by running sox over temporary files. The
+    # sox command lines are built once by commands() and
+    # segment_commands(), so they can also be run some other way, e.g.
+    # as asynchronous subprocesses by pipeline.py.
+    name = 'sox'
+
+    def render(self, input_path, output_file, segments, stats=None):
+        with self.commands(input_path, output_file, segments) as commands:
+            run_commands(commands)
+
+    def segment(self, input_path, output_file, segments):
+        with self.segment_commands(
+            input_path,
+            output_file,
+            segments,
+        ) as commands:
+            run_commands(commands)
+
+    def filter(self, input_path, output_file, start=None, end=None):
+        # Second process: filter, compress and EQ the
+        # audio in input_path and output to output_file,
+        # optionally only from start to end in seconds
+        run_commands([
+            sox_args(self.filter_transformer(start, end), input_path,
+                     output_file),
+        ])
+
+    @contextmanager
+    def commands(self, input_path, output_file, segments):
+        # The sox commands that render output_file, to be run in order.
+        # Their temporary files are removed on exit.
+        if not segments:
+            # Nothing to cut so downmix, normalise and filter the whole
+            # input in one pass
+            yield [sox_args(
+                self.filter_transformer(normalise=True),
+                input_path,
+                output_file,
+            )]
+            return
+
+        # Open a new temporary file to store audio in between processes
+        with TempFile('.mp3') as temp_file, self.segment_commands(
+            input_path,
+            temp_file.path,
+            segments,
+        ) as commands:
+            yield commands + [sox_args(
+                self.filter_transformer(),
+                temp_file.path,
+                output_file,
+            )]
+
+    @contextmanager
+    def segment_commands(self, input_path, output_file, segments):
+        # The sox commands that cut audio into segments and create fade
+        # in/out, writing the result in whatever format output_file
+        # has. With no segments the whole input is only downmixed and
+        # normalised.
+        if len(segments) < 2:
+            # Nothing to combine so write straight to output_file
+            yield [sox_args(
+                self.segment_transformer(segments[0] if segments else None),
+                input_path,
+                output_file,
+            )]
+            return
+
+        # We need to use a new temporary file for each audio segment,
+        # in the same format as output_file so nothing extra is lost
+        extension = os.path.splitext(output_file)[1]
+        temp_segments = [TempFile(extension) for segment in segments]
+        try:
+            commands = [
+                sox_args(
+                    self.segment_transformer(segment),
+                    input_path,
+                    temp_segment.path,
+                )
+                for segment, temp_segment in zip(segments, temp_segments)
+            ]
+
+            # Concatenate all the audio segments back together
+            # and output to output_file
+            commands.append(combine_args(
+                [temp_segment.path for temp_segment in temp_segments],
+                output_file,
+            ))
+            yield commands
+
+        finally:
+            # Cleanup temporary segment files even on error
+            for temp_segment in temp_segments:
+                temp_segment.close()
+
+    def segment_transformer(self, segment=None):
+        # Downmix, normalise, trim and fade a single segment, or only
+        # downmix and normalise the whole input if there is no segment
+        sox = Transformer()
+        sox.channels(CHANNELS)
+        sox.norm(NORM_DB)
+        if segment:
+            sox.trim(*segment)
+            sox.fade(FADE_IN, FADE_OUT, 't')
+        return sox
+
+    def filter_transformer(self, start=None, end=None, normalise=False):
+        sox = Transformer()
+        if normalise:
+            sox.channels(CHANNELS)
+            sox.norm(NORM_DB)
+        if start or end is not None:
+            sox.trim(start if start else 0, end)
+        sox.highpass(HIGHPASS)
+        sox.lowpass(LOWPASS)
+        sox.compand(
+            COMPAND_ATTACK,
+            COMPAND_DECAY,
+            COMPAND_KNEE_DB,
+            COMPAND_POINTS,
+        )
+        for equalizer in EQUALIZERS:
+            sox.equalizer(*equalizer)
+        return sox
+
+
+class ChunkedEngine:
+    # Render long recordings by filtering time chunks in parallel and
+    # stitching them back together. Every chunk after the first starts
+    # CHUNK_OVERLAP seconds early so the filters and compander have
+    # settled on the same state a serial render would have reached, and
+    # the last CHUNK_CROSSFADE seconds of that overlap are crossfaded
+    # with the end of the previous chunk.
+    def __init__(self, engine, chunk_seconds=CHUNK_SECONDS, workers=None):
+        self.engine = engine
+        self.name = engine.name
+        self.chunk_seconds = chunk_seconds
+        self.workers = workers if workers else os.cpu_count()
+
+    def render(self, input_path, output_file, segments, stats=None):
+        # If stats (a process.ThroughputStats) is given, every chunk is
+        # recorded against the thread that filtered it as it finishes
+        if segments:
+            seconds = sum(end - start for start, end in segments)
+        else:
+            seconds = file_info.duration(input_path)
+
+        chunks = int(seconds // self.chunk_seconds)
+        if chunks < 2 or self.workers < 2:
+            # Not long enough to be worth splitting
+            self.engine.render(input_path, output_file, segments)
+            return
+
+        with TempFile('.wav') as joined:
+            # Cut, downmix and normalise once into a WAV file that every
+            # chunk can seek, exactly as a serial render would
+            self.engine.segment(input_path, joined.path, segments)
+
+            # Chunk boundaries fall on whole seconds so every engine
+            # can trim them sample-accurately
+            seconds = int(file_info.duration(joined.path))
+            boundaries = [index * seconds // chunks for index in range(chunks)]
+            boundaries.append(None)
+
+            temp_chunks = [TempFile('.wav') for index in range(chunks)]
+            try:
+                # Threads are named by slot, chunk_0 and so on, so their
+                # throughput adds up across rows
+                with ThreadPoolExecutor(
+                    self.workers,
+                    thread_name_prefix='chunk',
+                ) as pool:
+                    futures = [
+                        pool.submit(
+                            self.filter_chunk,
+                            stats,
+                            (boundaries[index + 1] or seconds)
+                            - boundaries[index],
+                            joined.path,
+                            temp_chunks[index].path,
+                            max(boundaries[index] - CHUNK_OVERLAP, 0),
+                            boundaries[index + 1],
+                        )
+                        for index in range(chunks)
+                    ]
+                    self.stitch(
+                        joined.path,
+                        futures,
+                        [temp_chunk.path for temp_chunk in temp_chunks],
+                        boundaries,
+                        output_file,
+                    )
+            finally:
+                for temp_chunk in temp_chunks:
+                    temp_chunk.close()
+
+    def filter_chunk(self, stats, seconds, *args):
+        if not stats:
+            self.engine.filter(*args)
+            return
+
+        with stats.worker(seconds):
+            with stats.timer('filter chunk', seconds):
+                self.engine.filter(*args)
+
+    def stitch(self, joined_path, futures, chunk_paths, boundaries,
+               output_file):
+        # Join chunks in order as each one finishes rendering. NumPy is
+        # only imported once a recording is long enough to be chunked.
+        import numpy as np
+
+        rate = int(file_info.sample_rate(joined_path))
+        frames = int(file_info.num_samples(joined_path))
+
+        with TempFile('.f32') as stitched:
+            output = None
+            for index, future in enumerate(futures):
+                future.result()
+
+                with TempFile('.f32') as decoded:
+                    samples, _ = decode(chunk_paths[index], decoded.path)
+
+                    if output is None:
+                        channels = samples.shape[1]
+                        output = np.memmap(
+                            stitched.path,
+                            dtype=np.float32,
+                            mode='w+',
+                            shape=(max(frames, 1), channels),
+                        )
+
+                    start = boundaries[index] * rate
+                    lead = min(CHUNK_OVERLAP * rate, start)
+                    fade = min(round(CHUNK_CROSSFADE * rate), lead)
+
+                    if fade:
+                        weight = np.linspace(0, 1, fade + 2)[1:-1, None]
+                        output[start - fade:start] = (
+                            output[start - fade:start] * (1 - weight)
+                            + samples[lead - fade:lead] * weight
+                        )
+
+                    samples = samples[lead:frames - start + lead]
+                    output[start:start + len(samples)] = samples
+
+            output.flush()
+            del output
+
+            encode(stitched.path, rate, channels, output_file)
+
+
+def sox_args(transformer, input_path, output_file):
+    # The sox command line a Transformer would run to build
+    # output_file, so it can be run some other way, e.g. by asyncio.
+    # The engines never set an input or output format, which pysox
+    # stores differently between versions, so only the global options
+    # and effects are taken from the Transformer.
+    args = ['sox']
+    args.extend(transformer.globals)
+    args.append(input_path)
+    args.append(output_file)
+    args.extend(transformer.effects)
+    return args
+
+
+def combine_args(input_paths, output_file):
+    # The sox command line a Combiner would run to concatenate
+    # input_paths into output_file
+    args = ['sox']
+    args.extend(Combiner().globals)
+    args.extend(['--combine', 'concatenate'])
+    args.extend(input_paths)
+    args.append(output_file)
+    return args
+
+
+def run_commands(commands):
+    # Run sox commands one after another, raising CalledProcessError
+    # with the output of sox if any of them fails
+    for args in commands:
+        subprocess.run(
+            args,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+
+
+def get_engine(name='sox', chunk_seconds=None, workers=None):
+    # Build an engine by name. The numpy engine is imported lazily so
+    # hosts that only use sox do not pay for importing numpy and scipy.
+    # If chunk_seconds is given, long recordings are split into chunks
+    # of that length and filtered by up to workers threads in parallel.
+    if name == 'sox':
+        engine = SoxEngine()
+    elif name == 'numpy':
+        from dsp import NumpyEngine
+        engine = NumpyEngine()
+    else:
+        raise ValueError('Unknown audio engine: {}'.format(name))
+
+    if chunk_seconds:
+        engine = ChunkedEngine(engine, chunk_seconds, workers)
+
+    return engine
+
+
+def decode(input_path, output_path, start=None, end=None):
+    # Decode any file sox can read into raw 32 bit float PCM at
+    # output_path and memory-map it as a (frames, channels) array.
+    # Optionally only decode from start to end, in seconds.
+    import numpy as np
+
+    rate = int(file_info.sample_rate(input_path))
+    channels = file_info.channels(input_path)
+
+    trim = []
+    if start or end is not None:
+        trim = ['trim', '{:d}s'.format(round((start or 0) * rate))]
+        if end is not None:
+            trim.append('={:d}s'.format(round(end * rate)))
+
+    subprocess.run(
+        ['sox', input_path, '-t', 'f32', output_path] + trim,
+        check=True,
+    )
+
+    samples = np.memmap(output_path, dtype=np.float32, mode='r')
+    return samples.reshape(-1, channels), rate
+
+
+def write(output_path, frames, blocks):
+    # Write a stream of mono blocks into a raw 32 bit float PCM file
+    import numpy as np
+
+    output = np.memmap(
+        output_path,
+        dtype=np.float32,
+        mode='w+',
+        shape=(max(frames, 1),),
+    )
+
+    position = 0
+    for block in blocks:
+        output[position:position + len(block)] = block
+        position += len(block)
+
+    output.flush()
+
+
+def encode(input_path, rate, channels, output_file):
+    # Encode raw 32 bit float PCM into whatever format sox infers
+    # from the output file extension.
+    subprocess.run(
+        [
+            'sox',
+            '-t', 'f32', '-r', str(rate), '-c', str(channels), input_path,
+            output_file,
+        ],
+        check=True,
+    )
+
+
+class TempFile:
+    def __init__(self, prefix=None):
+        self.fd, self.path = mkstemp(prefix)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        os.close(self.fd)
+        os.remove(self.path)
+
+
+if __name__ == "__main__":
+    print(__doc__)
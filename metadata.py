@@ -12,12 +12,21 @@ and opening audio files, reading and writing metadata to csv.
 Classes and functions defined in this module include:
 
     VLCPlayer
+    Prefetcher
+    MetadataList
+    MetadataJournal
     write_metadata_csv
     read_metadata_csv
     print_metadata
     list_audio_files
+    split_list
+    parse_filename
+    read_schedule
+    read_id3_tags
+    probe_audio_file
     find
     timestamp_seconds
+    seconds_timestamp
     is_valid_segment
     Style
     print_info
@@ -29,15 +38,33 @@ Classes and functions defined in this module include:
 """
 
 import csv
+import json
 import os
 import re
 import subprocess
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from mutagen import File, MutagenError
 
 from ui import *
 
 # The list of extensions of file types that this module will process
 VALID_AUDIO = ('.mp3',)
 
+# Number of journal entries appended before the csv is rewritten
+JOURNAL_COMPACT_EVERY = 50
+
+# How many files ahead of the operator to prefetch, with how many
+# threads, and how many bytes to read at a time when warming the cache
+PREFETCH_LOOKAHEAD = 3
+PREFETCH_WORKERS = 2
+PREFETCH_CHUNK = 1 << 20
+
+# Delimiters between speakers and between segments in filenames
+SPEAKER_DELIMITER = re.compile(r'\s*(?:[,;&+]|\band\b)\s*')
+SEGMENT_DELIMITER = re.compile(r'\s*[,;]\s*')
+
 
 class VLCPlayer:
     # Provide a clean way to open an audio file with VLC, silence
@@ -59,6 +86,84 @@ class VLCPlayer:
         self.devnull.close()
 
 
+class Prefetcher:
+    # Look ahead of the operator in a list of audio files. While the
+    # current file is being described, a background pool reads the next
+    # few files into the page cache (so VLC opens them instantly, even
+    # from network mounts) and another probes their duration and ID3
+    # tags, so a probe never waits behind a slow read.
+    def __init__(
+        self,
+        audio_files,
+        lookahead=PREFETCH_LOOKAHEAD,
+        workers=PREFETCH_WORKERS,
+    ):
+        self.audio_files = audio_files
+        self.lookahead = lookahead
+        self.probe_pool = ThreadPoolExecutor(workers)
+        self.read_pool = ThreadPoolExecutor(workers)
+        self.stopped = threading.Event()
+        self.probes = {}
+        # Each read is a (future, event) pair, the event being set to
+        # abandon the read once the operator has moved past its file
+        self.reads = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def advance(self, index):
+        # Call when the operator moves on to audio_files[index]. The
+        # current file is probed first, then the files after it. Reads
+        # of files already passed are cancelled or abandoned.
+        passed = set(self.audio_files[:index])
+        for file in [file for file in self.reads if file in passed]:
+            future, abandoned = self.reads.pop(file)
+            future.cancel()
+            abandoned.set()
+
+        for file in self.audio_files[index:index + self.lookahead + 1]:
+            if file not in self.probes:
+                self.probes[file] = self.probe_pool.submit(
+                    probe_audio_file,
+                    file,
+                )
+        for file in self.audio_files[index + 1:index + self.lookahead + 1]:
+            if file not in self.reads:
+                abandoned = threading.Event()
+                future = self.read_pool.submit(self.read, file, abandoned)
+                self.reads[file] = (future, abandoned)
+
+    def get(self, file):
+        # Returns the probe of a file, waiting for it if need be
+        if file not in self.probes:
+            self.probes[file] = self.probe_pool.submit(probe_audio_file, file)
+        return self.probes[file].result()
+
+    def read(self, file, abandoned):
+        # Read a whole file and throw it away to pull it into the
+        # page cache, giving up early if the file is abandoned or the
+        # session ends
+        try:
+            with open(file, 'rb') as audio:
+                while not (self.stopped.is_set() or abandoned.is_set()):
+                    if not audio.read(PREFETCH_CHUNK):
+                        break
+        except OSError:
+            pass
+
+    def close(self):
+        self.stopped.set()
+        for future in self.probes.values():
+            future.cancel()
+        for future, abandoned in self.reads.values():
+            future.cancel()
+        self.probe_pool.shutdown(wait=False)
+        self.read_pool.shutdown(wait=False)
+
+
 class MetadataList(list):
     # Dictionary list of audio metadata in a specific format
     KEYS = ['filepath', 'event_name', 'title', 'speakers', 'segments']
@@ -92,7 +197,10 @@ class MetadataList(list):
                     row['segments'] = ';'.join(metadata['segments'])
                 rows.append(row)
 
-        with open(output_csv, "w", newline='') as file:
+        # Write to a temporary file first and swap it into place so a
+        # crash part way through never leaves a truncated csv behind
+        temp_csv = output_csv + '.tmp'
+        with open(temp_csv, "w", newline='') as file:
             writer = csv.DictWriter(
                 file,
                 self.KEYS,
@@ -100,6 +208,10 @@ class MetadataList(list):
             )
             writer.writeheader()
             writer.writerows(rows)
+            file.flush()
+            os.fsync(file.fileno())
+
+        os.replace(temp_csv, output_csv)
 
     def read_from_csv(self, input_csv):
         # Reads a csv file of audio metadata into a dictionary list
@@ -111,11 +223,65 @@ class MetadataList(list):
                 quoting=csv.QUOTE_ALL,
             )
             for row in reader:
-                row['speakers'] = row['speakers'].split(';')
-                row['segments'] = row['segments'].split(';')
+                row['speakers'] = split_list(row['speakers'])
+                row['segments'] = split_list(row['segments'])
                 self.add_item(row)
 
+    def import_metadata(
+        self,
+        audio_files,
+        event_name,
+        template=None,
+        schedule=None,
+        id3=False,
+        workers=None,
+    ):
+        # Fill in rows for audio files without prompting. Fields come
+        # from existing ID3 tags, then a regex template matched against
+        # the filename, then a schedule file, each overriding the last.
+        # Fields already in the list are never overwritten.
+        sources = []
+
+        if id3:
+            sources.append(read_id3_tags(audio_files, workers).get)
+        if template:
+            template = re.compile(template)
+            sources.append(lambda file: parse_filename(template, file))
+        if schedule:
+            schedule = read_schedule(schedule)
+            sources.append(lambda file: match_schedule(schedule, file))
+
+        for file in audio_files:
+            fields = {}
+            for source in sources:
+                found = source(file)
+                if found:
+                    fields.update({k: v for k, v in found.items() if v})
+
+            metadata = self.get_item('filepath', file)
+
+            if not metadata:
+                metadata = self.add_item({
+                    'filepath': file,
+                    'event_name': fields.pop('event_name', event_name),
+                    'title': None,
+                    'speakers': None,
+                    'segments': None,
+                })
+
+            for key, value in fields.items():
+                if not metadata[key]:
+                    metadata[key] = value
+
     class Metadata(dict):
+        def is_complete(self, require_segments=True):
+            # True if no field needs to be prompted for. Rendering does
+            # not need segments, as none means the whole file is used.
+            return all(
+                self.get(key) for key in MetadataList.KEYS
+                if require_segments or key != 'segments'
+            )
+
         def toId3(self):
             id3 = {}
             id3['title'] = self['title']
@@ -144,15 +310,94 @@ class MetadataList(list):
             print('{0}Speakers:{1}\t{2}'.format(
                 Style.BOLD,
                 Style.END,
-                ', '.join(self['speakers']),
+                ', '.join(self['speakers'] or []),
             ))
             print('{0}Segments:{1}\t{2}'.format(
                 Style.BOLD,
                 Style.END,
-                ', '.join(self['segments'])),
+                ', '.join(self['segments'] or [])),
             )
 
 
+class MetadataJournal:
+    # Append-only log of metadata edits kept beside the output csv.
+    # Every confirmed edit is appended and synced to disk straight away,
+    # so a crash loses no work and saving costs the same however big
+    # the catalogue is. The full csv is only rewritten (compacted) every
+    # so often and when the session ends, after which the journal is
+    # emptied. Edits left in a journal are replayed on the next start.
+    def __init__(self, metadata_list, output_csv, compact_every=None):
+        self.metadata_list = metadata_list
+        self.output_csv = output_csv
+        self.path = output_csv + '.journal'
+        self.compact_every = (
+            compact_every if compact_every else JOURNAL_COMPACT_EVERY
+        )
+        self.entries = 0
+        self.file = None
+
+    def replay(self):
+        # Apply edits left over from a session that did not end cleanly.
+        # Returns the number of edits recovered.
+        if not os.path.isfile(self.path):
+            return 0
+
+        recovered = 0
+        with open(self.path, 'r') as file:
+            for line in file:
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    # The last line may have been cut short by a crash
+                    break
+
+                metadata = self.metadata_list.get_item(
+                    'filepath',
+                    data['filepath'],
+                )
+                if metadata:
+                    metadata.update(data)
+                else:
+                    self.metadata_list.add_item(data)
+                recovered = recovered + 1
+
+        if recovered:
+            print_info('Recovered {0} edits from {1}'.format(
+                recovered,
+                self.path,
+            ))
+            self.compact()
+
+        return recovered
+
+    def append(self, metadata):
+        # Durably record a confirmed edit of a single metadata item
+        if not self.file:
+            self.file = open(self.path, 'a')
+
+        self.file.write(json.dumps(dict(metadata)) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+        self.entries = self.entries + 1
+        if self.entries >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        # Rewrite the full csv, then start a new empty journal
+        self.metadata_list.write_to_csv(self.output_csv)
+        self.close()
+
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        self.entries = 0
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
 def timestamp_seconds(seconds=None, minutes=None, hours=None):
     # Convert and audio timestamp in hours, minutes, seconds
     # into the total number of seconds. This function will generally
@@ -164,6 +409,13 @@ def timestamp_seconds(seconds=None, minutes=None, hours=None):
     return hours + minutes + seconds
 
 
+def seconds_timestamp(seconds):
+    # Format a number of seconds as an audio timestamp (hh:mm:ss)
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{0:02d}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+
+
 def segment_seconds(string):
     # Interpret audio segment made up of a start timestamp and end
     # timestamp delimited by '-' ([hh:]mm:ss-[hh:]mm:ss). Segments with
@@ -214,6 +466,130 @@ def is_valid_segment(string):
         return True
 
 
+def split_list(value, delimiter=';'):
+    # Accept a list or a delimited string, as found in csv, json and
+    # ID3 tags, and return a list of its stripped non-empty items.
+    if not value:
+        return []
+
+    if isinstance(value, str):
+        if isinstance(delimiter, str):
+            value = value.split(delimiter)
+        else:
+            value = delimiter.split(value)
+
+    return [item.strip() for item in value if item and item.strip()]
+
+
+def clean_fields(fields):
+    # Normalise imported metadata fields into the types used by
+    # MetadataList and drop anything unknown or invalid.
+    fields = {
+        k: v for k, v in fields.items()
+        if k in MetadataList.KEYS and k != 'filepath'
+    }
+
+    for key in ('title', 'event_name'):
+        if isinstance(fields.get(key), str):
+            fields[key] = fields[key].strip()
+
+    if 'speakers' in fields:
+        fields['speakers'] = split_list(fields['speakers'], SPEAKER_DELIMITER)
+
+    if 'segments' in fields:
+        segments = split_list(fields['segments'], SEGMENT_DELIMITER)
+        if all(map(is_valid_segment, segments)):
+            fields['segments'] = segments
+        else:
+            del fields['segments']
+
+    return fields
+
+
+def parse_filename(template, file):
+    # Match a compiled regex against the filename, without extension,
+    # and return its named groups (title, speakers, segments, event_name)
+    name = os.path.splitext(os.path.basename(file))[0]
+    match = template.search(name)
+    return clean_fields(match.groupdict()) if match else {}
+
+
+def read_schedule(schedule_file):
+    # Read a json or csv schedule of audio metadata into a dictionary
+    # keyed by filepath. Json may be a list of objects or an object
+    # keyed by filepath. Entries may name just the file, not the path.
+    print_info('Reading schedule from {}'.format(schedule_file))
+
+    with open(schedule_file, 'r', newline='') as file:
+        if schedule_file.lower().endswith('.json'):
+            rows = json.load(file)
+            if isinstance(rows, dict):
+                rows = [dict(row, filepath=key) for key, row in rows.items()]
+        else:
+            rows = list(csv.DictReader(file))
+
+    schedule = {}
+    for row in rows:
+        filepath = row.get('filepath') or row.get('filename')
+        if filepath:
+            schedule[os.path.normpath(filepath)] = clean_fields(row)
+
+    return schedule
+
+
+def match_schedule(schedule, file):
+    # Find the schedule entry for a file by its path or by its name
+    file = os.path.normpath(file)
+    return schedule.get(file) or schedule.get(os.path.basename(file))
+
+
+def read_id3_tags(audio_files, workers=None):
+    # Read the existing ID3 tags of every file in parallel and
+    # return a dictionary of metadata fields keyed by filepath.
+    with ThreadPoolExecutor(workers) as pool:
+        return dict(zip(audio_files, pool.map(read_id3_tag, audio_files)))
+
+
+def read_id3_tag(file, audio=None):
+    # Read the existing tags of a file, or of a mutagen file already
+    # opened with easy=True
+    if audio is None:
+        try:
+            audio = File(file, easy=True)
+        except MutagenError:
+            return {}
+
+    if not audio or not audio.tags:
+        return {}
+
+    def first(key):
+        values = audio.tags.get(key)
+        return values[0] if values else None
+
+    return clean_fields({
+        'title': first('title'),
+        'speakers': ', '.join(audio.tags.get('artist', [])),
+        'event_name': first('album'),
+    })
+
+
+def probe_audio_file(file):
+    # Find the duration in seconds and existing ID3 tags of an audio
+    # file, parsing it only once
+    try:
+        audio = File(file, easy=True)
+    except MutagenError:
+        return {'duration': None, 'tags': {}}
+
+    if audio is None:
+        return {'duration': None, 'tags': {}}
+
+    return {
+        'duration': audio.info.length,
+        'tags': read_id3_tag(file, audio),
+    }
+
+
 def list_audio_files(path):
     # Search the given input directory for all audio that matches
     # valid file extensions and returns a list of their paths.
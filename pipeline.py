@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+
+"""
+pipeline.py
+
+This module is an asyncio library API for embedding the CAPS pipeline
+in other services. Rows of metadata are submitted to a Pipeline, which
+cuts, filters, encodes and tags them with bounded concurrency and
+returns a Job for each row that can be awaited or cancelled. Progress
+events for every job can be streamed from Pipeline.events().
+
+The sox engine runs as asynchronous subprocesses, so cancelling a job
+kills its sox processes and removes its temporary and partial output
+files straight away. Other engines, including a chunked sox engine,
+run in a thread pool that cannot be interrupted, so a cancelled job
+waits for its current render to return before cleaning up.
+
+    async with Pipeline('./processed', concurrency=4) as pipeline:
+        jobs = [pipeline.submit(metadata) for metadata in metadata_list]
+        async for event in pipeline.events():
+            print(event.job.metadata['title'], event.state, event.seconds)
+
+#---------------------------------------------------------------------#
+
+Classes and functions defined in this module include:
+
+    Pipeline
+    Job
+    Event
+    run_sox
+    run_in_thread
+"""
+
+import asyncio
+import os
+import subprocess
+
+from collections import namedtuple
+
+from metadata import *
+from engine import *
+from process import (
+    Rendition,
+    ThroughputStats,
+    audio_seconds,
+    make_output_dirs,
+    parse_segments,
+    remove_files,
+    tag,
+)
+
+# A change in the state of a job: started, rendering, cut, encoded,
+# tagged, done, failed or cancelled. seconds is how much of the job's
+# audio has been rendered so far, for progress. Engines that render in
+# chunks emit a rendering event as each chunk finishes, others only
+# move from 0 to the whole job at cut. error is set when a job has
+# failed.
+Event = namedtuple('Event', ['job', 'state', 'seconds', 'error'])
+
+# The states a job finishes in
+FINAL_STATES = ('done', 'failed', 'cancelled')
+
+
+class Job:
+    # A single row submitted to a Pipeline. Await the job for the list
+    # of files it wrote, or cancel it.
+    def __init__(self, metadata):
+        self.metadata = metadata
+        # The length of audio the job will produce, once it has started
+        self.seconds = None
+        self.rendered = 0
+        self.state = 'pending'
+        self.outputs = []
+        self.error = None
+        self.task = None
+
+    def __await__(self):
+        return self.task.__await__()
+
+    def cancel(self):
+        return self.task.cancel()
+
+    def done(self):
+        # True once the job's final event has been emitted
+        return self.state in FINAL_STATES
+
+
+class Pipeline:
+    def __init__(
+        self,
+        output_dir=None,
+        engine=None,
+        renditions=None,
+        concurrency=None,
+    ):
+        self.engine = engine if engine else SoxEngine()
+        self.renditions = renditions if renditions else [Rendition()]
+        self.output_dir = make_output_dirs(output_dir, self.renditions)
+        self.concurrency = concurrency if concurrency else os.cpu_count()
+        self.jobs = []
+        self.semaphore = None
+        self.queue = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close(cancel=type is not None)
+
+    def submit(self, metadata):
+        # Schedule a row of metadata and return its Job. Must be called
+        # from a running event loop.
+        if not isinstance(metadata, MetadataList.Metadata):
+            metadata = MetadataList.Metadata(metadata)
+
+        # Rows with no segments are rendered whole
+        if not metadata.is_complete(require_segments=False):
+            raise ValueError('Metadata for {} is incomplete'.format(
+                metadata.get('filepath'),
+            ))
+
+        if not self.semaphore:
+            # Created here so they belong to the running event loop
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+            self.queue = asyncio.Queue()
+
+        job = Job(metadata)
+        job.task = asyncio.ensure_future(self.run_job(job))
+        job.task.add_done_callback(lambda task: self.cancelled(job, task))
+        self.jobs.append(job)
+        return job
+
+    async def run(self, metadata_list):
+        # Process every row and return their jobs once all have
+        # finished. Failed jobs have their error set.
+        jobs = [self.submit(metadata) for metadata in metadata_list]
+        await asyncio.gather(*jobs, return_exceptions=True)
+        return jobs
+
+    async def events(self):
+        # Yield an Event every time a job changes state, until every
+        # submitted job has finished
+        while self.queue and (
+            not self.queue.empty()
+            or not all(job.done() for job in self.jobs)
+        ):
+            yield await self.queue.get()
+
+    async def close(self, cancel=False):
+        # Wait for every job to finish, or cancel them first
+        if cancel:
+            for job in self.jobs:
+                job.cancel()
+        await asyncio.gather(*self.jobs, return_exceptions=True)
+
+    def emit(self, job, state, error=None):
+        job.state = state
+        job.error = error
+        self.queue.put_nowait(Event(job, state, job.rendered, error))
+
+    def progress(self, job, audio):
+        # Called in the event loop as the engine reports rendered audio
+        if job.state in ('started', 'rendering'):
+            job.rendered = min(job.rendered + audio, job.seconds)
+            self.emit(job, 'rendering')
+
+    def cancelled(self, job, task):
+        # A job cancelled before it first ran never reached run_job()
+        if task.cancelled() and not job.done():
+            self.emit(job, 'cancelled')
+
+    async def run_job(self, job):
+        metadata = job.metadata
+        outputs = [
+            rendition.output_file(self.output_dir, metadata['title'])
+            for rendition in self.renditions
+        ]
+
+        started = False
+
+        try:
+            async with self.semaphore:
+                started = True
+                # Probing may be slow on network mounts, so keep it off
+                # the event loop
+                job.seconds = await run_in_thread(audio_seconds, metadata)
+                self.emit(job, 'started')
+
+                renditions = self.renditions
+                if len(renditions) == 1 and renditions[0].is_direct():
+                    # The engine can write the only output itself
+                    await self.render(job, outputs[0])
+                    job.rendered = job.seconds
+                    self.emit(job, 'cut')
+                else:
+                    # Decode and filter once, then encode every
+                    # rendition from the same processed audio
+                    with TempFile('.wav') as processed:
+                        await self.render(job, processed.path)
+                        job.rendered = job.seconds
+                        self.emit(job, 'cut')
+                        await self.encode(processed.path, outputs)
+                    self.emit(job, 'encoded')
+
+                for rendition, output_file in zip(renditions, outputs):
+                    await run_in_thread(
+                        tag,
+                        output_file,
+                        rendition.tags(metadata),
+                    )
+                self.emit(job, 'tagged')
+
+        except asyncio.CancelledError:
+            if started:
+                remove_files(outputs)
+            self.emit(job, 'cancelled')
+            raise
+        except Exception as error:
+            if started:
+                remove_files(outputs)
+            self.emit(job, 'failed', error)
+            raise
+
+        job.outputs = outputs
+        self.emit(job, 'done')
+        return outputs
+
+    async def render(self, job, output_file):
+        input_path = job.metadata['filepath']
+        segments = parse_segments(job.metadata)
+
+        if not isinstance(self.engine, SoxEngine):
+            # Engines that run in-process are rendered in a thread, and
+            # report their progress back to the event loop
+            loop = asyncio.get_running_loop()
+            stats = ThroughputStats(
+                lambda audio: loop.call_soon_threadsafe(
+                    self.progress,
+                    job,
+                    audio,
+                )
+            )
+            await run_in_thread(
+                self.engine.render,
+                input_path,
+                output_file,
+                segments,
+                stats,
+            )
+            return
+
+        # The same commands SoxEngine.render() runs, as asynchronous
+        # subprocesses
+        with self.engine.commands(
+            input_path,
+            output_file,
+            segments,
+        ) as commands:
+            for args in commands:
+                await run_sox(args)
+
+    async def encode(self, input_path, outputs):
+        tasks = [
+            asyncio.ensure_future(
+                run_sox(rendition.sox_args(input_path, output_file))
+            )
+            for rendition, output_file in zip(self.renditions, outputs)
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # Make sure no encoder outlives a failed or cancelled job
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def run_sox(args):
+    # Run a sox command without blocking the event loop. The process is
+    # killed if the calling task is cancelled.
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+
+    try:
+        _, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+
+    if process.returncode:
+        raise subprocess.CalledProcessError(
+            process.returncode,
+            args,
+            stderr=stderr,
+        )
+
+
+async def run_in_thread(function, *args):
+    # Run a blocking function in the default thread pool. A thread can
+    # not be stopped, so if the calling task is cancelled wait for the
+    # function to return before re-raising, so that the files it is
+    # writing can be cleaned up afterwards.
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(None, function, *args)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        while not future.done():
+            try:
+                await asyncio.wait([future])
+            except asyncio.CancelledError:
+                pass
+        raise
+
+
+if __name__ == "__main__":
+    print(__doc__)
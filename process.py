@@ -6,6 +6,10 @@
 
 # Options:
 #   Path to export processed audio (default = input_dir + '_processed')
+#   Audio engine to render with (sox or numpy, default = sox)
+#   Minutes per chunk when rendering long recordings (default = 30, 0 = off)
+#   Number of chunks to render in parallel (default = cpu count)
+#   Json config of renditions to publish (default = one full quality MP3)
 
 # 1. retrieve audio metadata
 #
@@ -27,116 +31,211 @@
 #
 
 import timeit
+import threading
 import sys
 import logging
 import subprocess
 import os
 import getopt
+import json
 
 from ui import *
 from metadata import *
+from engine import *
 
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
-from tempfile import mkstemp
-from sox import Transformer, Combiner
 from mutagen.easyid3 import EasyID3
 from mutagen.id3 import ID3NoHeaderError
 from mutagen import File
 
+# The ID3 tags tag() writes, as returned by Metadata.toId3()
+TAG_KEYS = ('title', 'artist', 'album')
 
-def process_audio(metadata_list, output_dir=None):
+
+def process_audio(
+    metadata_list,
+    output_dir=None,
+    engine=None,
+    renditions=None,
+):
     # Silence PySox warnings and info
     logging.getLogger('sox').setLevel(logging.ERROR)
 
-    output_dir = output_dir if output_dir else './processed'
-    if not os.path.isdir(output_dir):
-        os.mkdir(output_dir)
+    engine = engine if engine else SoxEngine()
+    renditions = renditions if renditions else [Rendition()]
+
+    # Imported metadata may be incomplete until someone fills it in
+    # with collect.py, so leave those rows for a later run. Rows with
+    # no segments are rendered whole.
+    incomplete = [
+        item for item in metadata_list
+        if not item.is_complete(require_segments=False)
+    ]
+    if incomplete:
+        print_error('Skipping {} audio files with incomplete metadata'.format(
+            len(incomplete)
+        ))
+        metadata_list = [
+            item for item in metadata_list
+            if item.is_complete(require_segments=False)
+        ]
+
+    output_dir = make_output_dirs(output_dir, renditions)
+
+    # Progress is measured in seconds of audio rather than files so that
+    # a short intro and a long panel move the bar (and the ETA) in
+    # proportion to the work they actually take.
+    durations = [round(audio_seconds(metadata)) for metadata in metadata_list]
+    stats = ThroughputStats()
 
     try:
         progress_bar = tqdm(
-            total=len(metadata_list),
+            total=sum(durations),
+            unit='s',
             bar_format='{desc}{percentage:3.0f}%|'
                        '{bar}'
-                       '| {n_fmt}/{total_fmt} ETA {remaining}'
+                       '| {n_fmt}/{total_fmt}s{postfix} ETA {remaining}'
         )
-        for metadata in metadata_list:
+
+        def progress(audio):
+            # Called whenever a chunk or a row finishes being rendered,
+            # possibly from a worker thread
+            progress_bar.update(audio)
+            progress_bar.set_postfix_str('{:.1f}x realtime'.format(
+                stats.realtime_factor()
+            ))
+
+        stats.callback = progress
+
+        for metadata, seconds in zip(metadata_list, durations):
             title = metadata['title']
             input_path = metadata['filepath']
-            output_file = os.path.join(
-                output_dir,
-                '{0}{1}'.format(title, '.mp3')
-            )
+            outputs = [
+                rendition.output_file(output_dir, title)
+                for rendition in renditions
+            ]
 
             progress_bar.set_description(title)
 
-            cut(input_path, output_file, metadata)
-            tag(output_file, metadata.toId3())
-            progress_bar.update(1)
+            if len(renditions) == 1 and renditions[0].is_direct():
+                # The engine can write the only output itself
+                render(
+                    input_path,
+                    outputs[0],
+                    metadata,
+                    engine,
+                    stats,
+                    seconds,
+                )
+            else:
+                # Decode and filter once into a lossless file,
+                # then encode every rendition from it in parallel
+                with TempFile('.wav') as processed:
+                    render(
+                        input_path,
+                        processed.path,
+                        metadata,
+                        engine,
+                        stats,
+                        seconds,
+                    )
+
+                    def encode(rendition, output_file):
+                        with stats.worker(seconds, advance=False):
+                            with stats.timer(
+                                'encode {}'.format(rendition.name),
+                                seconds,
+                            ):
+                                rendition.encode(processed.path, output_file)
+
+                    try:
+                        with ThreadPoolExecutor(
+                            len(renditions),
+                            thread_name_prefix='encode',
+                        ) as pool:
+                            futures = [
+                                pool.submit(encode, rendition, output_file)
+                                for rendition, output_file
+                                in zip(renditions, outputs)
+                            ]
+                            for future in futures:
+                                future.result()
+                    except BaseException:
+                        # The pool has waited for every encoder, so
+                        # remove the partial outputs of the others
+                        remove_files(outputs)
+                        raise
+
+            with stats.timer('tag', seconds):
+                for rendition, output_file in zip(renditions, outputs):
+                    tag(output_file, rendition.tags(metadata))
 
         progress_bar.close()
 
     except (KeyboardInterrupt, EOFError):
         print_error('\nAborted')
+    finally:
+        stats.print_summary()
 
 
-def cut(input_path, output_file, metadata):
-    segments = metadata['segments']
-    segments = [segment_seconds(segment) for segment in segments]
+def render(input_path, output_file, metadata, engine, stats, seconds):
+    # Cut a row and advance progress by whatever the engine did not
+    # already report from its own worker threads (e.g. chunks), crediting
+    # that remainder to the current thread.
+    with stats.timer('cut', seconds):
+        with stats.worker(0) as worker:
+            before = stats.audio
+            cut(input_path, output_file, metadata, engine, stats)
+            worker.audio = max(seconds - (stats.audio - before), 0)
 
-    with TempFile('.mp3') as temp_file:
-        # Open a new temporary file to store audio in between processes
-        if segments:
-            # Cut audio into segments and create fade in/out
-            # We need to use a new temporary file for each
-            # audio segment
-            temp_segments = [TempFile('.mp3') for segment in segments]
-            try:
-                for index, segment in enumerate(segments):
-                    sox = Transformer()
-                    sox.channels(1)
-                    sox.norm(-24)
-                    sox.trim(*segment)
-                    sox.fade(1, 2, 't')
-                    sox.build(input_path, temp_segments[index].path)
-
-                if len(segments) > 1:
-                    # Concatenate all the audio segments back together
-                    # and output to our main temporary file
-                    Combiner().build(
-                        [temp_segment.path for temp_segment in temp_segments],
-                        temp_file.path,
-                        'concatenate',
-                    )
-                else:
-                    # Only one segment so we don't need to combine anything
-                    subprocess.run(
-                        ['cp', temp_segments[0].path, temp_file.path]
-                    )
 
-            except Exception as e:
-                raise(e)
-            finally:
-                # Cleanup temporary segment files even on error
-                if temp_segments:
-                    for temp_segment in temp_segments:
-                        temp_segment.close()
-
-        # Second process: filter, compress and EQ the
-        # audio in temporary file and output to output_file
-        sox = Transformer()
-        sox.highpass(100)
-        sox.lowpass(10000)
-        sox.compand(0.005, 0.12, 6, [
-            (-90, -90),
-            (-70, -55),
-            (-50, -35),
-            (-32, -32),
-            (-24, -24),
-            (0, -8),
-        ])
-        sox.equalizer(3000, 1000, 3)
-        sox.equalizer(280, 120, 3)
-        sox.build(temp_file.path, output_file)
+def make_output_dirs(output_dir, renditions):
+    # Create the output directory of every rendition and return
+    # the top level output directory
+    output_dir = output_dir if output_dir else './processed'
+    if not os.path.isdir(output_dir):
+        os.mkdir(output_dir)
+
+    for rendition in renditions:
+        directory = os.path.join(output_dir, rendition.directory)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    return output_dir
+
+
+def remove_files(paths):
+    # Remove partially written outputs of a failed or cancelled row
+    for path in paths:
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def audio_seconds(metadata):
+    # The length of audio a row will produce. This is the sum of its
+    # segments, or the length of the whole file if it has no segments.
+    segments = parse_segments(metadata)
+
+    if segments:
+        return sum(end - start for start, end in segments)
+
+    audio = File(metadata['filepath'])
+    return audio.info.length if audio is not None else 0
+
+
+def cut(input_path, output_file, metadata, engine=None, stats=None):
+    engine = engine if engine else SoxEngine()
+    engine.render(input_path, output_file, parse_segments(metadata), stats)
+
+
+def parse_segments(metadata):
+    # The (start, end) seconds of every segment of a row. Imported
+    # rows may have no segments at all, meaning the whole file.
+    return [
+        segment_seconds(segment)
+        for segment in metadata.get('segments') or [] if segment
+    ]
 
 
 def tag(input_file, metadata):
@@ -154,19 +253,122 @@ def tag(input_file, metadata):
     audio.save()
 
 
-class TempFile:
-    def __init__(self, prefix=None):
-        self.fd, self.path = mkstemp(prefix)
+class Rendition:
+    # One of the outputs published for every row. Renditions are encoded
+    # from the same processed audio and each can be trimmed (e.g. to a
+    # preview clip), resampled, encoded at its own MP3 bitrate and
+    # tagged with its own metadata. Tags are format strings filled in
+    # from the row's ID3 metadata, e.g. {"title": "{title} (Preview)"}.
+    def __init__(
+        self,
+        name='archive',
+        directory='',
+        suffix='',
+        bitrate=None,
+        rate=None,
+        start=None,
+        duration=None,
+        fade=None,
+        tags=None,
+    ):
+        self.name = name
+        self.directory = directory
+        self.suffix = suffix
+        self.bitrate = bitrate
+        self.rate = rate
+        self.start = start
+        self.duration = duration
+        self.fade = fade
+        self.tags_format = tags if tags else {}
+
+    def is_direct(self):
+        # True if the engine output needs no further encoding
+        return not any([
+            self.bitrate,
+            self.rate,
+            self.start,
+            self.duration,
+            self.fade,
+        ])
 
-    def __enter__(self):
-        return self
+    def output_file(self, output_dir, title):
+        return os.path.join(
+            output_dir,
+            self.directory,
+            '{0}{1}{2}'.format(title, self.suffix, '.mp3'),
+        )
 
-    def __exit__(self, type, value, traceback):
-        self.close()
+    def encode(self, input_path, output_file):
+        subprocess.run(self.sox_args(input_path, output_file), check=True)
+
+    def sox_args(self, input_path, output_file):
+        # The sox command line that encodes this rendition
+        args = ['sox', input_path]
+        if self.bitrate:
+            args.extend(['-C', str(self.bitrate)])
+        args.append(output_file)
+
+        if self.start or self.duration:
+            args.extend(['trim', str(self.start if self.start else 0)])
+            if self.duration:
+                args.append(str(self.duration))
+        if self.rate:
+            args.extend(['rate', str(self.rate)])
+        if self.fade:
+            args.extend(['fade', 't', '0', '-0', str(self.fade)])
+
+        return args
+
+    def tags(self, metadata):
+        fields = metadata.toId3()
+        id3 = dict(fields)
+        for key, value in self.tags_format.items():
+            id3[key] = value.format(**fields)
+        return id3
+
+
+def read_renditions(config_file):
+    # Read the list of renditions to publish from a json config file
+    # of the form {"renditions": [{"name": "archive", ...}, ...]}
+    with open(config_file, 'r') as file:
+        config = json.load(file)
+
+    renditions = [Rendition(**rendition) for rendition in config['renditions']]
+
+    names = set()
+    outputs = set()
+    for rendition in renditions:
+        if rendition.name in names:
+            raise ValueError('Rendition {} is defined twice'.format(
+                rendition.name,
+            ))
+        names.add(rendition.name)
+
+        # Renditions writing to the same file would overwrite each other
+        output = (os.path.normpath(rendition.directory), rendition.suffix)
+        if output in outputs:
+            raise ValueError('Rendition {} has the same output path as '
+                             'another rendition'.format(rendition.name))
+        outputs.add(output)
+
+        # Try every tag format now rather than part way through a run
+        if not isinstance(rendition.tags_format, dict):
+            raise ValueError('Rendition {} tags must be an object'.format(
+                rendition.name,
+            ))
+        for key, value in rendition.tags_format.items():
+            if key not in TAG_KEYS:
+                raise ValueError('Rendition {0} has unknown tag {1}'.format(
+                    rendition.name,
+                    key,
+                ))
+            try:
+                value.format(**{field: '' for field in TAG_KEYS})
+            except (KeyError, IndexError, ValueError, AttributeError) as err:
+                raise ValueError('Rendition {0} has invalid {1} tag {2!r}: '
+                                 '{3!r}'.format(rendition.name, key, value, err))
 
-    def close(self):
-        os.close(self.fd)
-        os.remove(self.path)
+    return renditions
 
 
 class SimpleTimer:
@@ -183,15 +385,112 @@ class SimpleTimer:
         print('{0} in {1}s'.format(self.name, time))
 
 
+class ThroughputStats:
+    # Accumulate seconds of audio processed and wall clock time taken,
+    # per processing stage and per worker thread, so the realtime factor
+    # can be reported while running and summarised at the end. The
+    # callback is called with every advance of rendered audio.
+    def __init__(self, callback=None):
+        self.stages = {}
+        self.workers = {}
+        self.audio = 0
+        self.callback = callback
+        self.start = timeit.default_timer()
+        self.lock = threading.Lock()
+
+    def add(self, totals, key, audio, wall):
+        with self.lock:
+            total_audio, total_wall = totals.get(key, (0, 0))
+            totals[key] = (total_audio + audio, total_wall + wall)
+
+    def advance(self, audio):
+        # Record that audio seconds more of the run have been rendered
+        with self.lock:
+            self.audio = self.audio + audio
+        if self.callback:
+            self.callback(audio)
+
+    def timer(self, stage, audio):
+        # Time a single processing stage of a row
+        return self.Timer(self, self.stages, stage, audio)
+
+    def worker(self, audio, advance=True):
+        # Time work done by the current thread. Unless advance is False
+        # the audio also counts towards the progress of the run. Pools
+        # are created per row, so worker threads must be given a
+        # thread_name_prefix to be recorded by slot rather than by pool.
+        worker = threading.current_thread().name
+        return self.Timer(self, self.workers, worker, audio, advance)
+
+    def realtime_factor(self):
+        # Seconds of rendered audio per second of elapsed wall time
+        elapsed = timeit.default_timer() - self.start
+        return self.audio / elapsed if elapsed else 0
+
+    def print_summary(self):
+        if not self.stages:
+            return
+
+        print_title('\nThroughput')
+        for heading, totals in (('Stage', self.stages),
+                                ('Worker', self.workers)):
+            print('{0}{1}{2}'.format(Style.BOLD, heading, Style.END))
+            for key, (audio, wall) in totals.items():
+                print('  {0:<16}{1:>10} audio in {2:>8}  {3:>7.1f}x'.format(
+                    key,
+                    tqdm.format_interval(audio),
+                    tqdm.format_interval(wall),
+                    audio / wall if wall else 0,
+                ))
+        print('{0}Overall:{1} {2:.1f}x realtime'.format(
+            Style.BOLD,
+            Style.END,
+            self.realtime_factor(),
+        ))
+
+    class Timer:
+        # The audio of a timer may be changed before it exits, for work
+        # whose amount is only known afterwards. Timers of no audio are
+        # not recorded.
+        def __init__(self, stats, totals, key, audio, advance=False):
+            self.stats = stats
+            self.totals = totals
+            self.key = key
+            self.audio = audio
+            self.advance = advance
+
+        def __enter__(self):
+            self.start = timeit.default_timer()
+            return self
+
+        def __exit__(self, type, value, traceback):
+            if type is None and self.audio:
+                wall = timeit.default_timer() - self.start
+                self.stats.add(self.totals, self.key, self.audio, wall)
+                if self.advance:
+                    self.stats.advance(self.audio)
+
+
 def _args():
     input_csv = None
     output_dir = None
+    engine = 'sox'
+    chunk_minutes = 30
+    workers = None
+    renditions = None
 
     try:
         opts, args = getopt.gnu_getopt(
             sys.argv[1:],
-            'o:h',
-            ['output-dir=', 'help']
+            'o:e:m:w:c:h',
+            [
+                'output-dir=',
+                'engine=',
+                'chunk-minutes=',
+                'workers=',
+                'config=',
+                'help',
+            ]
         )
     except getopt.GetoptError as err:
         print(str(err))
@@ -203,11 +502,40 @@ def _args():
             sys.exit(0)
         elif option in ('-o', '--output-dir'):
             output_dir = value
+        elif option in ('-e', '--engine'):
+            engine = value
+        elif option in ('-m', '--chunk-minutes'):
+            chunk_minutes = value
+        elif option in ('-w', '--workers'):
+            workers = value
+        elif option in ('-c', '--config'):
+            try:
+                renditions = read_renditions(value)
+            except (OSError, ValueError, KeyError, TypeError) as err:
+                print_error('{0} is not a valid config: {1}'.format(
+                    value,
+                    err,
+                ))
+                sys.exit(1)
 
     if output_dir and not os.path.isdir(output_dir):
         print_error('{} is not a valid output dir'.format(output_dir))
         sys.exit(1)
 
+    if engine not in ENGINES:
+        print_error('{0} is not a valid engine ({1})'.format(
+            engine,
+            ', '.join(ENGINES),
+        ))
+        sys.exit(1)
+
+    try:
+        chunk_minutes = int(chunk_minutes)
+        workers = int(workers) if workers else None
+    except ValueError:
+        print_error('Chunk minutes and workers must be whole numbers')
+        sys.exit(1)
+
     if args:
         input_csv = args[0]
     else:
@@ -218,11 +546,13 @@ def _args():
         print_error('{} is not a valid input file'.format(input_csv))
         sys.exit(1)
 
-    return input_csv, output_dir
+    engine = get_engine(engine, chunk_minutes * 60, workers)
+
+    return input_csv, output_dir, engine, renditions
 
 
 if __name__ == '__main__':
-    input_csv, output_dir = _args()
+    input_csv, output_dir, engine, renditions = _args()
     metadata_list = MetadataList()
     metadata_list.read_from_csv(input_csv)
-    process_audio(metadata_list, output_dir)
+    process_audio(metadata_list, output_dir, engine, renditions)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""
+test_dsp.py
+
+Checks that rendering a long recording in parallel chunks with
+engine.ChunkedEngine matches a serial render of the numpy engine. sox is replaced by an in-memory
+store of sample arrays so the tests run without it.
+"""
+
+import numpy as np
+import pytest
+
+import dsp
+import engine
+from process import ThroughputStats
+
+RATE = 22050
+
+
+@pytest.fixture
+def store(monkeypatch):
+    # Stand in for sox: "files" are arrays of samples keyed by path
+    store = {}
+
+    def decode(input_path, output_path, start=None, end=None):
+        samples = store[input_path]
+        start = round(start * RATE) if start else 0
+        end = len(samples) if end is None else round(end * RATE)
+        return samples[start:end], RATE
+
+    def encode(input_path, rate, channels, output_file):
+        samples = np.memmap(input_path, dtype=np.float32, mode='r')
+        store[output_file] = np.array(samples).reshape(-1, channels)
+
+    class FileInfo:
+        @staticmethod
+        def duration(path):
+            return len(store[path]) / RATE
+
+        @staticmethod
+        def sample_rate(path):
+            return RATE
+
+        @staticmethod
+        def num_samples(path):
+            return len(store[path])
+
+    for module in (dsp, engine):
+        monkeypatch.setattr(module, 'decode', decode)
+        monkeypatch.setattr(module, 'encode', encode)
+        monkeypatch.setattr(module, 'file_info', FileInfo)
+
+    # Two minutes of loud stereo speech-like noise with quiet passages
+    random = np.random.RandomState(0)
+    samples = random.randn(120 * RATE, 2) * 0.3
+    samples[40 * RATE:50 * RATE] *= 0.01
+    store['input.mp3'] = samples.astype(np.float32)
+
+    return store
+
+
+def error_db(samples, reference):
+    # RMS error relative to the RMS of the reference, in dB
+    error = samples.astype(np.float64) - reference.astype(np.float64)
+    return 20 * np.log10(
+        np.sqrt(np.mean(np.square(error)))
+        / np.sqrt(np.mean(np.square(reference.astype(np.float64))))
+    )
+
+
+@pytest.mark.parametrize('segments', [
+    [(5, 70), (80, 118)],
+    [],
+])
+def test_chunked_render_matches_serial(store, segments):
+    numpy_engine = dsp.NumpyEngine()
+    numpy_engine.render('input.mp3', 'serial.mp3', segments)
+
+    chunked = engine.ChunkedEngine(
+        numpy_engine,
+        chunk_seconds=40,
+        workers=3,
+    )
+    chunked.render('input.mp3', 'chunked.mp3', segments)
+
+    serial = store['serial.mp3']
+    assert store['chunked.mp3'].shape == serial.shape
+    assert error_db(store['chunked.mp3'], serial) < -120
+
+
+def test_chunk_workers_are_recorded_by_slot(store):
+    stats = ThroughputStats()
+    chunked = engine.ChunkedEngine(
+        dsp.NumpyEngine(),
+        chunk_seconds=40,
+        workers=2,
+    )
+    for row in range(3):
+        chunked.render('input.mp3', 'chunked.mp3', [], stats)
+
+    assert set(stats.workers) == {'chunk_0', 'chunk_1'}
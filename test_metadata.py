@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+"""
+test_metadata.py
+
+Checks that the metadata journal recovers every confirmed edit after a
+crash, including a crash part way through writing an edit or compacting
+the journal into the csv, and that imported fields are cleaned and
+matched to their files.
+"""
+
+import csv
+import json
+import os
+import re
+
+import pytest
+
+from metadata import (
+    MetadataJournal,
+    MetadataList,
+    clean_fields,
+    match_schedule,
+    parse_filename,
+    read_schedule,
+)
+
+
+def row(filepath, title, segments=None):
+    return {
+        'filepath': filepath,
+        'event_name': 'PyCon',
+        'title': title,
+        'speakers': ['Ada Lovelace'],
+        'segments': segments if segments else [],
+    }
+
+
+def read_csv(output_csv):
+    metadata_list = MetadataList()
+    metadata_list.read_from_csv(output_csv)
+    return metadata_list
+
+
+@pytest.fixture
+def output_csv(tmp_path):
+    # A csv of one row, as saved at the end of a previous session
+    output_csv = str(tmp_path / 'metadata.csv')
+    metadata_list = MetadataList()
+    metadata_list.add_item(row('intro.mp3', 'Intro'))
+    metadata_list.write_to_csv(output_csv)
+    return output_csv
+
+
+def edit(output_csv, compact_every=None):
+    # Confirm an edit of the existing row and a new row, then crash
+    # before the session ends
+    metadata_list = read_csv(output_csv)
+    journal = MetadataJournal(metadata_list, output_csv, compact_every)
+
+    metadata = metadata_list.get_item('filepath', 'intro.mp3')
+    metadata['segments'] = ['00:00:10-00:05:00']
+    journal.append(metadata)
+    journal.append(metadata_list.add_item(row('talk.mp3', 'Talk')))
+
+    # Crash: the journal is closed but never compacted
+    if journal.file:
+        journal.file.close()
+    return metadata_list, journal
+
+
+def recover(output_csv):
+    metadata_list = read_csv(output_csv)
+    recovered = MetadataJournal(metadata_list, output_csv).replay()
+    return metadata_list, recovered
+
+
+def assert_edited(metadata_list):
+    assert metadata_list == [
+        row('intro.mp3', 'Intro', ['00:00:10-00:05:00']),
+        row('talk.mp3', 'Talk'),
+    ]
+
+
+def test_replay_recovers_edits(output_csv):
+    _, journal = edit(output_csv)
+    assert read_csv(output_csv) == [row('intro.mp3', 'Intro')]
+
+    metadata_list, recovered = recover(output_csv)
+
+    assert recovered == 2
+    assert_edited(metadata_list)
+    # Recovered edits are compacted straight into the csv
+    assert not os.path.exists(journal.path)
+    assert_edited(read_csv(output_csv))
+
+
+def test_replay_skips_truncated_last_line(output_csv):
+    _, journal = edit(output_csv)
+    with open(journal.path, 'a') as file:
+        file.write(json.dumps(row('outro.mp3', 'Outro'))[:20])
+
+    metadata_list, recovered = recover(output_csv)
+
+    assert recovered == 2
+    assert_edited(metadata_list)
+
+
+def test_compaction_rewrites_csv_and_deletes_journal(output_csv):
+    metadata_list, journal = edit(output_csv, compact_every=2)
+
+    assert not os.path.exists(journal.path)
+    assert_edited(read_csv(output_csv))
+    assert recover(output_csv)[1] == 0
+
+
+def test_replay_after_crash_mid_compaction(output_csv):
+    # The csv was rewritten but the journal not yet deleted, so every
+    # edit is replayed a second time over the compacted csv
+    metadata_list, journal = edit(output_csv)
+    metadata_list.write_to_csv(output_csv)
+
+    metadata_list, recovered = recover(output_csv)
+
+    assert recovered == 2
+    assert_edited(metadata_list)
+    assert_edited(read_csv(output_csv))
+
+
+def test_clean_fields():
+    assert clean_fields({
+        'filepath': 'ignored.mp3',
+        'title': '  Keynote ',
+        'event_name': ' PyCon ',
+        'speakers': 'Ada Lovelace, Grace Hopper and Alan Turing',
+        'segments': '00:00:10-00:05:00; 00:06:00-00:10:00',
+        'room': 'Hall A',
+    }) == {
+        'title': 'Keynote',
+        'event_name': 'PyCon',
+        'speakers': ['Ada Lovelace', 'Grace Hopper', 'Alan Turing'],
+        'segments': ['00:00:10-00:05:00', '00:06:00-00:10:00'],
+    }
+
+
+def test_clean_fields_drops_invalid_segments():
+    assert clean_fields({'segments': '00:00:10-00:05:00, soon'}) == {}
+
+
+def test_parse_filename():
+    template = re.compile(r'(?P<title>.+) - (?P<speakers>.+)')
+
+    assert parse_filename(
+        template,
+        os.path.join('talks', 'Keynote - Ada Lovelace & Grace Hopper.mp3'),
+    ) == {
+        'title': 'Keynote',
+        'speakers': ['Ada Lovelace', 'Grace Hopper'],
+    }
+    assert parse_filename(template, 'Keynote.mp3') == {}
+
+
+@pytest.mark.parametrize('name', ['list.json', 'dict.json', 'schedule.csv'])
+def test_read_schedule(tmp_path, name):
+    entries = [
+        {'filepath': 'talks/keynote.mp3', 'title': 'Keynote'},
+        {'filename': 'panel.mp3', 'speakers': 'Ada Lovelace; Grace Hopper'},
+    ]
+    schedule_file = str(tmp_path / name)
+
+    with open(schedule_file, 'w', newline='') as file:
+        if name == 'list.json':
+            json.dump(entries, file)
+        elif name == 'dict.json':
+            json.dump({
+                'talks/keynote.mp3': {'title': 'Keynote'},
+                'panel.mp3': {'speakers': 'Ada Lovelace; Grace Hopper'},
+            }, file)
+        else:
+            writer = csv.DictWriter(
+                file,
+                ['filepath', 'filename', 'title', 'speakers'],
+            )
+            writer.writeheader()
+            writer.writerows(entries)
+
+    schedule = read_schedule(schedule_file)
+
+    assert match_schedule(schedule, 'talks/./keynote.mp3')['title'] == (
+        'Keynote'
+    )
+    # Entries naming only the file match it in any directory
+    assert match_schedule(schedule, 'day2/panel.mp3')['speakers'] == [
+        'Ada Lovelace',
+        'Grace Hopper',
+    ]
+    assert match_schedule(schedule, 'talks/outro.mp3') is None
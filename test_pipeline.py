@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""
+test_pipeline.py
+
+Checks the events a Pipeline emits, with a stand-in engine that
+reports its progress like ChunkedEngine, so the tests run without sox.
+"""
+
+import asyncio
+import os
+import wave
+
+import pytest
+
+import pipeline
+from pipeline import Pipeline
+
+RATE = 8000
+
+
+class ChunkingEngine:
+    # Writes a placeholder output, reporting one chunk per second
+    name = 'chunking'
+
+    def render(self, input_path, output_file, segments, stats=None):
+        for chunk in range(3):
+            with stats.worker(1):
+                pass
+        with open(output_file, 'wb') as file:
+            file.write(b'audio')
+
+
+def write_wav(path, seconds):
+    with wave.open(path, 'wb') as audio:
+        audio.setnchannels(1)
+        audio.setsampwidth(2)
+        audio.setframerate(RATE)
+        audio.writeframes(b'\0\0' * RATE * seconds)
+
+
+def row(path):
+    return {
+        'filepath': path,
+        'event_name': 'PyCon',
+        'title': os.path.splitext(os.path.basename(path))[0],
+        'speakers': ['Ada Lovelace'],
+        'segments': None,
+    }
+
+
+def run(output_dir, rows):
+    async def main():
+        async with Pipeline(output_dir, ChunkingEngine()) as pipeline:
+            for metadata in rows:
+                pipeline.submit(metadata)
+            return [
+                (event.job.metadata['title'], event.state, event.seconds)
+                async for event in pipeline.events()
+            ]
+
+    return asyncio.run(main())
+
+
+@pytest.fixture(autouse=True)
+def tags(monkeypatch):
+    monkeypatch.setattr(pipeline, 'tag', lambda output_file, tags: None)
+
+
+def test_events_report_rendered_seconds(tmp_path):
+    audio_file = str(tmp_path / 'Keynote.wav')
+    write_wav(audio_file, 3)
+
+    events = run(str(tmp_path / 'processed'), [row(audio_file)])
+
+    assert events == [
+        ('Keynote', 'started', 0),
+        ('Keynote', 'rendering', 1),
+        ('Keynote', 'rendering', 2),
+        ('Keynote', 'rendering', 3),
+        ('Keynote', 'cut', 3),
+        ('Keynote', 'tagged', 3),
+        ('Keynote', 'done', 3),
+    ]
+
+
+def test_unreadable_file_fails_its_job(tmp_path):
+    audio_file = str(tmp_path / 'Missing.wav')
+
+    events = run(str(tmp_path / 'processed'), [row(audio_file)])
+
+    assert events == [('Missing', 'failed', 0)]
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""
+test_process.py
+
+Checks process_audio() end to end with a stand-in engine that records
+what it was asked to render, so the tests run without sox, and that
+invalid rendition configs are rejected when they are read.
+"""
+
+import json
+import os
+import subprocess
+import wave
+
+import pytest
+
+import process
+from metadata import MetadataList
+
+RATE = 8000
+
+
+class RecordingEngine:
+    # Writes a placeholder output and remembers every render
+    name = 'recording'
+
+    def __init__(self):
+        self.renders = []
+
+    def render(self, input_path, output_file, segments, stats=None):
+        self.renders.append((input_path, segments))
+        with open(output_file, 'wb') as file:
+            file.write(b'audio')
+
+
+def write_wav(path, seconds):
+    with wave.open(str(path), 'wb') as audio:
+        audio.setnchannels(1)
+        audio.setsampwidth(2)
+        audio.setframerate(RATE)
+        audio.writeframes(b'\0\0' * RATE * seconds)
+
+
+@pytest.fixture
+def tags(monkeypatch):
+    tags = {}
+    monkeypatch.setattr(process, 'tag', tags.__setitem__)
+    return tags
+
+
+def test_imported_row_renders_whole_file(tmp_path, tags):
+    audio_file = str(tmp_path / 'Keynote - Ada Lovelace.wav')
+    write_wav(audio_file, 2)
+
+    metadata_list = MetadataList()
+    metadata_list.import_metadata(
+        [audio_file],
+        'PyCon',
+        template=r'(?P<title>.+) - (?P<speakers>.+)',
+    )
+    assert metadata_list[0]['segments'] is None
+
+    engine = RecordingEngine()
+    output_dir = str(tmp_path / 'processed')
+    process.process_audio(metadata_list, output_dir, engine)
+
+    output_file = os.path.join(output_dir, 'Keynote.mp3')
+    assert engine.renders == [(audio_file, [])]
+    assert os.path.isfile(output_file)
+    assert tags[output_file] == {
+        'title': 'Keynote',
+        'artist': 'Ada Lovelace',
+        'album': 'PyCon',
+    }
+
+
+def test_failed_encode_leaves_no_outputs(tmp_path, tags, monkeypatch):
+    audio_file = str(tmp_path / 'Keynote - Ada Lovelace.wav')
+    write_wav(audio_file, 2)
+
+    def encode(rendition, input_path, output_file):
+        with open(output_file, 'wb') as file:
+            file.write(b'partial')
+        if rendition.name == 'mobile':
+            raise subprocess.CalledProcessError(2, 'sox')
+
+    monkeypatch.setattr(process.Rendition, 'encode', encode)
+
+    metadata_list = MetadataList()
+    metadata_list.import_metadata(
+        [audio_file],
+        'PyCon',
+        template=r'(?P<title>.+) - (?P<speakers>.+)',
+    )
+    renditions = [
+        process.Rendition('archive', bitrate=192),
+        process.Rendition('mobile', directory='mobile', bitrate=48),
+    ]
+    output_dir = str(tmp_path / 'processed')
+
+    with pytest.raises(subprocess.CalledProcessError):
+        process.process_audio(
+            metadata_list,
+            output_dir,
+            RecordingEngine(),
+            renditions,
+        )
+
+    assert not os.path.exists(os.path.join(output_dir, 'Keynote.mp3'))
+    assert not os.path.exists(
+        os.path.join(output_dir, 'mobile', 'Keynote.mp3')
+    )
+    assert not tags
+
+
+@pytest.mark.parametrize('renditions', [
+    [{'name': 'archive'}, {'name': 'archive', 'directory': 'mobile'}],
+    [{'name': 'archive'}, {'name': 'mobile', 'directory': './'}],
+    [{'name': 'archive', 'tags': {'genre': 'Talk'}}],
+    [{'name': 'archive', 'tags': {'title': '{title} by {speakers}'}}],
+    [{'name': 'archive', 'tags': {'title': '{0}'}}],
+    [{'name': 'archive', 'tags': ['title']}],
+])
+def test_read_renditions_rejects_invalid_config(tmp_path, renditions):
+    config_file = str(tmp_path / 'renditions.json')
+    with open(config_file, 'w') as file:
+        json.dump({'renditions': renditions}, file)
+
+    with pytest.raises(ValueError):
+        process.read_renditions(config_file)
+
+
+def test_read_renditions_example():
+    renditions = process.read_renditions(os.path.join(
+        os.path.dirname(__file__),
+        'renditions.example.json',
+    ))
+    assert [rendition.name for rendition in renditions] == [
+        'archive',
+        'mobile',
+        'preview',
+    ]